@@ -1,52 +1,230 @@
 import os
 import streamlit as st
-from langchain_ollama import ChatOllama
-from langchain.schema import HumanMessage, SystemMessage
-from datetime import datetime
+import ollama
+# langchain_core carries just the message types; the langchain.schema shim imports the whole langchain package
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 import json
-from PIL import Image
-from io import BytesIO
+import ast
+import asyncio
 import base64
-import html
+import codecs
+import hashlib
 import re
+import subprocess
+import sys
 import time
 import requests
-from typing import Optional
+from requests.adapters import HTTPAdapter
+import httpx
+import threading
+from syntax_check import parse_error
+from typing import TYPE_CHECKING, Final, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+if TYPE_CHECKING:
+    from langchain_ollama import ChatOllama
+
+try:
+    import orjson  # Optional: much faster JSON serialization for saved outputs
+except ImportError:
+    orjson = None
+
+try:
+    import hyperscan  # Optional: SIMD multi-pattern matching for the unsafe-code scan
+except ImportError:
+    hyperscan = None
+
+try:
+    import tokenizers  # Optional: exact CodeLlama token counts for the input size gate
+except ImportError:
+    tokenizers = None
+
+try:
+    import diskcache  # Optional: persists cached model responses across restarts
+except ImportError:
+    diskcache = None
+
+# Must be the first Streamlit command: any element (including a cached call's spinner) before it raises
+st.set_page_config(layout="wide") # Use wide layout for better code display
 
 # ========== Setup Paths ==========
 BASE_DIR = os.path.expanduser("~/myworkspace/utilities/code-demo")
-FILES_DIR = os.path.join(BASE_DIR, "files")
-os.makedirs(FILES_DIR, exist_ok=True)
+
+@st.cache_resource(show_spinner=False)
+def _ensure_files_dir() -> str:
+    """Create the output directory once per process rather than on every rerun."""
+    files_dir = os.path.join(BASE_DIR, "files")
+    os.makedirs(files_dir, exist_ok=True)
+    return files_dir
+
+FILES_DIR = _ensure_files_dir()
+
+# ========== UI Constants ==========
+# Static HTML/CSS and the default system prompt are built once at import time.
+_BASE_CSS: Final[str] = """
+    <style>
+    html, body, [class*="css"]  {
+        font-family: 'Montserrat', sans-serif;
+    }
+
+    h1, h2, h3, h4, h5 {
+        color: #2D2042;
+    }
+
+    .stButton > button {
+        background-color: #60B5E5 !important;
+        color: white !important;
+        font-weight: 600;
+        border-radius: 8px;
+    }
+
+    .stSidebar h1, .stSidebar h2, .stSidebar h3, .stSidebar h4, .stSidebar h5 {
+        color: #60B5E5 !important;
+    }
+
+    section[data-testid="stFileUploader"] > div {
+        box-shadow: 0px 1px 5px rgba(0, 0, 0, 0.05);
+        border-radius: 8px;
+        padding: 1rem;
+    }
+
+    #MainMenu {visibility: hidden;}
+    /* footer {visibility: hidden;} */
+    /* header {visibility: hidden;} */
+    </style>
+    """
+
+# Montserrat is inlined from files/fonts when available so first paint doesn't wait on Google Fonts
+FONTS_DIR = os.path.join(FILES_DIR, "fonts")
+_MONTSERRAT_FONT_FILES: Final[dict[int, str]] = {
+    400: "Montserrat-Regular.woff2",
+    600: "Montserrat-SemiBold.woff2",
+}
+_FONT_FACE_TMPL: Final[str] = (
+    "@font-face {{ font-family: 'Montserrat'; font-style: normal; font-weight: {weight}; "
+    "font-display: swap; src: url(data:font/woff2;base64,{data}) format('woff2'); }}"
+)
+_REMOTE_FONT_CSS: Final[str] = (
+    "<style>@import url('https://fonts.googleapis.com/css2?family=Montserrat:wght@400;600&display=swap');</style>"
+)
+
+_HEADER_TMPL: Final[str] = """
+        <div style='display: flex; align-items: center; gap: 1rem; margin-bottom: 1.5rem;'>
+            <img src='data:image/jpeg;base64,{logo_base64}' style='vertical-align: middle;' width='50'>
+            <h1 style='margin: 0; font-family: Montserrat, sans-serif; color: #2D2042;'>Local Python Code Assistant with Codellama:7b-instruct</h1>
+        </div>
+        """
+
+# --- ENHANCED System Prompt ---
+_DEFAULT_SYS_PROMPT: Final[str] = """
+You are a helpful and concise AI code assistant. Your primary goal is to analyze user-submitted Python code and respond accurately and effectively based on the specified task.
+
+- **Explaining Code**:
+  Provide a clear and beginner-friendly explanation. Your explanation should cover:
+  1. The overall purpose and functionality of the code.
+  2. A breakdown of key components (functions, classes, significant logic blocks).
+  3. The expected input(s) and output(s).
+  4. Any potential edge cases or notable behaviors you observe.
+  Be thorough yet concise.
+
+- **Refactoring Code**:
+  Your goal is to improve the code based on specified focus areas (e.g., clarity, maintainability, performance, Pythonic idioms).
+  Please provide:
+  1. A clear explanation of the changes you made and the reasoning behind them.
+  2. The complete, revised Python code block.
+  3. Ensure the code block includes concise inline comments (`#`) for significant changes.
+  Ensure the refactored code remains functionally equivalent to the original.
+
+- **Debugging Code**:
+  Analyze the code for bugs, errors, and potential issues. Present your findings in a structured manner:
+  1.  **Bug Identification**: Clearly list each bug or issue found. Explain *why* it is an issue (e.g., syntax error, logical flaw, runtime risk, deviation from best practices).
+  2.  **Proposed Fixes**: For each identified bug, describe the necessary changes to correct it.
+  3.  **Corrected Code**: Provide the complete Python code block with all identified bugs fixed.
+
+Always use Markdown for formatting your response. Code blocks must be enclosed in triple backticks (```python ... ```).
+"""
+
+# --- Styled System Prompt Section ---
+_SIDEBAR_SYS_PROMPT_BLURB_HTML: Final[str] = """
+    <div style='border: 1px solid #e6e6e6; padding: 12px; border-radius: 8px; background-color: #f9f9f9; margin-top: 10px; margin-bottom: 20px;'>
+        <strong style='color: #2D2042;'>System Prompt</strong><br>
+        <small style='color: #666;'>Customize how the model behaves. Use markdown-friendly formatting.</small>
+    </div>
+"""
+
+# Footer Branding
+_FOOTER_HTML: Final[str] = """
+    <hr style='margin-top: 3rem;'>
+    <div style='text-align: center; color: #2D2042;'>Smarter Paths Forward</div>
+"""
 
 # ========== Model Connection Error Handling ==========
-def initialize_llm_with_retry(max_retries: int = 3, retry_delay: float = 2.0) -> Optional[ChatOllama]:
+OLLAMA_HOST = "http://localhost:11434"
+OLLAMA_MODEL = "codellama:7b-instruct"
+OLLAMA_OPTIONS = {"temperature": 0.1, "top_p": 0.9, "num_ctx": 4096}
+# Keep the model (and its cached system-prompt prefix) loaded between requests
+OLLAMA_KEEP_ALIVE = "30m"
+
+# Transient failures talking to Ollama; other errors are raised or reported without retrying
+_RETRYABLE = (ConnectionError, TimeoutError, requests.exceptions.RequestException, httpx.TransportError)
+
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """Return a keep-alive HTTP session to Ollama shared across reruns and sessions."""
+    session = requests.Session()
+    # Retries are handled by initialize_llm_with_retry, not by urllib3
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def create_chat_model() -> "ChatOllama":
+    """Construct the ChatOllama client with the app's model parameters."""
+    # Imported on first use: it is only needed once the Ollama service has answered
+    from langchain_ollama import ChatOllama
+
+    return ChatOllama(
+        model=OLLAMA_MODEL,
+        base_url=OLLAMA_HOST,
+        keep_alive=OLLAMA_KEEP_ALIVE,
+        **OLLAMA_OPTIONS
+    )
+
+def initialize_llm_with_retry(max_retries: int = 3, retry_delay: float = 2.0, verify_model: bool = False) -> "ChatOllama":
     """
     Initialize ChatOllama with robust error handling and retry logic.
     
+    Nothing is rendered here, so the function is safe to call from st.cache_resource,
+    which would otherwise replay its messages on every cache hit.
+    
     Args:
         max_retries: Maximum number of connection attempts
         retry_delay: Delay between retry attempts in seconds
+        verify_model: Also send a test prompt and wait for a non-empty reply
+            before returning; off by default since it blocks on a full inference
         
     Returns:
-        ChatOllama instance or None if connection fails
+        ChatOllama instance
+        
+    Raises:
+        Exception: The last error once all attempts fail, or a non-connection error immediately
     """
     for attempt in range(max_retries):
         try:
             # Test if Ollama service is running
             try:
-                response = requests.get("http://localhost:11434/api/tags", timeout=5)
+                response = get_http_session().get(f"{OLLAMA_HOST}/api/tags", timeout=5)
                 if response.status_code != 200:
                     raise ConnectionError("Ollama service not responding")
             except requests.exceptions.RequestException:
                 raise ConnectionError("Cannot connect to Ollama service")
             
             # Initialize the model
-            llm = ChatOllama(
-                model="codellama:7b-instruct",
-                temperature=0.1,
-                top_p=0.9,
-                num_ctx=4096
-            )
+            llm = create_chat_model()
+            
+            if not verify_model:
+                return llm
             
             # Test the model with a simple query
             test_response = llm.invoke([
@@ -60,57 +238,225 @@ def initialize_llm_with_retry(max_retries: int = 3, retry_delay: float = 2.0) ->
                 raise ValueError("Model responded with empty content")
                 
         except Exception as e:
-            if attempt < max_retries - 1:
-                st.warning(f"Connection attempt {attempt + 1} failed: {str(e)}. Retrying in {retry_delay} seconds...")
+            # Only connection problems are worth retrying; anything else fails the same way again
+            if attempt < max_retries - 1 and isinstance(e, _RETRYABLE):
                 time.sleep(retry_delay)
             else:
-                st.error(f"Failed to initialize model after {max_retries} attempts: {str(e)}")
-                st.error("Please ensure Ollama is running and the codellama:7b-instruct model is available.")
-                return None
-    
-    return None
+                raise
 
 # ========== Initialize Model ==========
-llm = initialize_llm_with_retry()
+def warm_up_model() -> None:
+    """Have Ollama load the model before the first real request, without generating a reply."""
+    try:
+        # A generate request with no prompt only loads the model, so nothing queues ahead of real requests.
+        # The options must match real requests: Ollama reloads the model when e.g. num_ctx differs.
+        ollama.Client(host=OLLAMA_HOST).generate(
+            model=OLLAMA_MODEL, options=OLLAMA_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE
+        )
+    except Exception:
+        # Best effort only; real requests report their own errors
+        pass
 
-# ========== Custom Styling ==========
-def get_base_css():
-    return """
-    <style>
-    @import url('https://fonts.googleapis.com/css2?family=Montserrat:wght@400;600&display=swap');
+@st.cache_resource(show_spinner=False)
+def get_llm() -> "ChatOllama":
+    """
+    Return a ChatOllama client shared across all reruns and sessions.
+    
+    A failed connection raises, and st.cache_resource doesn't cache exceptions,
+    so the next rerun tries again.
+    """
+    llm_instance = initialize_llm_with_retry()
+    # Load the model in the background instead of blocking the first page load
+    threading.Thread(target=warm_up_model, daemon=True).start()
+    return llm_instance
 
-    html, body, [class*="css"]  {
-        font-family: 'Montserrat', sans-serif;
-    }
+# Connection problems are reported here, outside the cached call, so they are shown only while they last
+try:
+    llm = get_llm()
+except Exception as e:
+    st.error(f"Failed to initialize model: {str(e)}")
+    st.error("Please ensure Ollama is running and the codellama:7b-instruct model is available.")
+    llm = None
 
-    h1, h2, h3, h4, h5 {
-        color: #2D2042;
-    }
+# ========== Helper Functions ==========
+MAX_FILE_SIZE = 1024 * 1024  # 1MB in bytes
 
-    .stButton > button {
-        background-color: #60B5E5 !important;
-        color: white !important;
-        font-weight: 600;
-        border-radius: 8px;
-    }
+# Token limits based on model context window
+MAX_TOKENS = 3000  # Conservative limit for 4K context window
+WARN_TOKENS = 2000  # Warning threshold
 
-    .stSidebar h1, .stSidebar h2, .stSidebar h3, .stSidebar h4, .stSidebar h5 {
-        color: #60B5E5 !important;
-    }
+# Potentially unsafe code patterns reported for uploaded files
+DANGEROUS_PATTERNS = [
+    r'import\s+subprocess',
+    r'import\s+os',
+    r'exec\s*\(',
+    r'eval\s*\(',
+    r'__import__\s*\(',
+    r'open\s*\(',
+    r'file\s*\(',
+    r'input\s*\(',
+    r'raw_input\s*\(',
+    r'compile\s*\(',
+    r'globals\s*\(',
+    r'locals\s*\(',
+    r'vars\s*\(',
+    r'dir\s*\(',
+    r'getattr\s*\(',
+    r'setattr\s*\(',
+    r'hasattr\s*\(',
+    r'delattr\s*\(',
+]
+_DANGEROUS_PATTERN_LABELS = [
+    pattern.replace(r'\s+', ' ').replace(r'\s*', '').replace(r'\(', '(') for pattern in DANGEROUS_PATTERNS
+]
+# Compiled once; separate searches keep re's fast literal-prefix scan, which an alternation loses
+_DANGEROUS_RES = [re.compile(pattern, re.IGNORECASE) for pattern in DANGEROUS_PATTERNS]
 
-    section[data-testid="stFileUploader"] > div {
-        box-shadow: 0px 1px 5px rgba(0, 0, 0, 0.05);
-        border-radius: 8px;
-        padding: 1rem;
-    }
+@st.cache_resource(show_spinner=False)
+def get_hyperscan_db():
+    """Compile DANGEROUS_PATTERNS into a Hyperscan database once per process, or return None if unavailable."""
+    if hyperscan is None:
+        return None
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[pattern.encode() for pattern in DANGEROUS_PATTERNS],
+        ids=list(range(len(DANGEROUS_PATTERNS))),
+        elements=len(DANGEROUS_PATTERNS),
+        flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * len(DANGEROUS_PATTERNS),
+    )
+    # The database's scratch space can only serve one scan at a time
+    return db, threading.Lock()
 
-    #MainMenu {visibility: hidden;}
-    /* footer {visibility: hidden;} */
-    /* header {visibility: hidden;} */
-    </style>
+def find_dangerous_patterns(content: str) -> list[str]:
     """
+    Return the readable labels of DANGEROUS_PATTERNS that occur in content, in pattern order.
+    
+    Uses Hyperscan's multi-pattern DFA (a single pass) when installed, otherwise
+    one search per precompiled pattern in _DANGEROUS_RES.
+    """
+    hs = get_hyperscan_db()
+    if hs is not None:
+        db, lock = hs
+        found = set()
+
+        def on_match(pattern_id, start, end, flags, context):
+            found.add(pattern_id)
+
+        with lock:
+            db.scan(content.encode("utf-8"), match_event_handler=on_match)
+        return [label for i, label in enumerate(_DANGEROUS_PATTERN_LABELS) if i in found]
+
+    return [label for label, regex in zip(_DANGEROUS_PATTERN_LABELS, _DANGEROUS_RES) if regex.search(content)]
+
+_UTF8_DECODE = codecs.lookup("utf-8").decode
+
+def decode_uploaded_file(file) -> str:
+    """
+    Decode an upload as UTF-8, rejecting content over MAX_FILE_SIZE bytes.
+    
+    getvalue() shares the in-memory buffer instead of copying it and doesn't
+    depend on the read position, and oversized content is rejected before any
+    decoding happens, so the only allocation is the decoded string.
+    
+    Args:
+        file: Streamlit uploaded file object
+        
+    Returns:
+        Decoded file content
+    """
+    raw = file.getvalue()
+    if len(raw) > MAX_FILE_SIZE:
+        raise ValueError(f"File content exceeds maximum allowed size ({MAX_FILE_SIZE} bytes)")
+    content, _ = _UTF8_DECODE(raw)
+    return content
+
+def _scan_lines(content: str, long_thresh: int) -> tuple[list[str], list[int]]:
+    """
+    Split content into lines and find the long ones in a single pass.
+    
+    Args:
+        content: Text to scan
+        long_thresh: Lines longer than this many characters are reported
+        
+    Returns:
+        tuple: (lines, long_line_numbers)
+    """
+    lines = content.split('\n')
+    long_line_numbers = [i for i, line in enumerate(lines, 1) if len(line) > long_thresh]
+    return lines, long_line_numbers
+
+def _is_repetitive(lines: list[str]) -> bool:
+    """Return True if fewer than half of the lines are distinct non-empty stripped lines."""
+    unique_lines = {line.strip() for line in lines}
+    unique_lines.discard("")
+    return len(unique_lines) < len(lines) * 0.5
+
+# Large sources are parsed in a separate interpreter so a pathological upload can't stall the app
+SAFE_PARSE_THRESHOLD = 100 * 1024  # 100KB
+PARSE_TIMEOUT = 2.0  # seconds
+SYNTAX_CHECK_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "syntax_check.py")
+# Prefix of the warning shown when the check could not run; such results are never cached
+SYNTAX_CHECK_SKIPPED = "Python syntax check skipped"
+
+def _safe_parse(code: str) -> Optional[tuple[str, Optional[int]]]:
+    """
+    Like parse_error, but large code is parsed by syntax_check.py in a subprocess with a time limit.
+    
+    The subprocess is started with exec rather than fork, which is safe from the
+    multithreaded server, and only the outcome comes back, never the AST.
+    
+    Raises:
+        TimeoutError: If parsing takes longer than PARSE_TIMEOUT
+        RuntimeError: If the parser process fails without an answer
+    """
+    if len(code) <= SAFE_PARSE_THRESHOLD:
+        return parse_error(code)
+    try:
+        # -I: isolated mode, the helper only needs the standard library
+        result = subprocess.run(
+            [sys.executable, "-I", SYNTAX_CHECK_SCRIPT],
+            input=code.encode("utf-8"),
+            capture_output=True,
+            timeout=PARSE_TIMEOUT,
+        )
+    except subprocess.TimeoutExpired:
+        # subprocess.run kills the runaway parser before raising
+        raise TimeoutError(f"parsing did not finish within {PARSE_TIMEOUT:g} seconds")
+    if result.returncode != 0:
+        raise RuntimeError("the parser process exited unexpectedly")
+    error = json.loads(result.stdout)
+    return None if error is None else tuple(error)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def find_syntax_error(code: str) -> Optional[tuple[str, Optional[int]]]:
+    """
+    Parse code once and remember the outcome across reruns.
+    
+    An uploaded file is checked when it is read and again when it is submitted;
+    the second check is served from the cache. A timeout or parser crash raises
+    instead, and st.cache_data doesn't cache exceptions, so the next check retries.
+    
+    Returns:
+        (message, line number) of the first syntax error, or None if the code parses
+    """
+    return _safe_parse(code)
+
+def syntax_error_message(code: str, filename: str) -> Optional[str]:
+    """Format the syntax error in code the way str(SyntaxError) would, or return None."""
+    error = find_syntax_error(code)
+    if error is None:
+        return None
+    msg, lineno = error
+    return msg if lineno is None else f"{msg} ({filename}, line {lineno})"
+
+def syntax_warning(code: str, filename: str) -> Optional[str]:
+    """Return the warning to show for code's syntax check, or None if it parses."""
+    try:
+        error = syntax_error_message(code, filename)
+    except (TimeoutError, RuntimeError) as e:
+        return f"{SYNTAX_CHECK_SKIPPED}: {e}"
+    return f"Python syntax error detected: {error}" if error else None
 
-# ========== Helper Functions ==========
 def validate_and_read_code_file(file) -> tuple[str, list[str]]:
     """
     Validate and read uploaded code file with comprehensive security checks.
@@ -124,76 +470,72 @@ def validate_and_read_code_file(file) -> tuple[str, list[str]]:
     warnings = []
     
     # Check file size (max 1MB)
-    MAX_FILE_SIZE = 1024 * 1024  # 1MB in bytes
     if file.size > MAX_FILE_SIZE:
         raise ValueError(f"File size ({file.size} bytes) exceeds maximum allowed size ({MAX_FILE_SIZE} bytes)")
     
     # Read file content
     try:
-        content = file.read().decode("utf-8")
+        content = decode_uploaded_file(file)
     except UnicodeDecodeError as e:
         raise ValueError(f"File contains invalid UTF-8 characters: {str(e)}")
     
     # Check for potentially unsafe code patterns
-    dangerous_patterns = [
-        r'import\s+subprocess',
-        r'import\s+os',
-        r'exec\s*\(',
-        r'eval\s*\(',
-        r'__import__\s*\(',
-        r'open\s*\(',
-        r'file\s*\(',
-        r'input\s*\(',
-        r'raw_input\s*\(',
-        r'compile\s*\(',
-        r'globals\s*\(',
-        r'locals\s*\(',
-        r'vars\s*\(',
-        r'dir\s*\(',
-        r'getattr\s*\(',
-        r'setattr\s*\(',
-        r'hasattr\s*\(',
-        r'delattr\s*\(',
-    ]
-    
-    found_patterns = []
-    for pattern in dangerous_patterns:
-        if re.search(pattern, content, re.IGNORECASE):
-            found_patterns.append(pattern.replace(r'\s+', ' ').replace(r'\s*', '').replace(r'\(', '('))
+    found_patterns = find_dangerous_patterns(content)
     
     if found_patterns:
         warnings.append(f"Potentially unsafe code patterns detected: {', '.join(found_patterns)}")
     
     # Check for very long lines that might cause issues
-    lines = content.split('\n')
-    long_lines = [i+1 for i, line in enumerate(lines) if len(line) > 500]
+    _, long_lines = _scan_lines(content, 500)
     if long_lines:
         warnings.append(f"Very long lines detected (>500 chars) at line numbers: {long_lines[:5]}")
     
     # Basic syntax validation for Python files
     if file.name.endswith('.py'):
-        try:
-            compile(content, file.name, 'exec')
-        except SyntaxError as e:
-            warnings.append(f"Python syntax error detected: {str(e)}")
+        warning = syntax_warning(content, file.name)
+        if warning:
+            warnings.append(warning)
     
     return content, warnings
 
+def upload_key(file) -> tuple:
+    """Identify an uploaded file across reruns."""
+    return (file.file_id, file.name, file.size)
+
 def read_code_file(file):
-    """Legacy function for backward compatibility"""
-    content, warnings = validate_and_read_code_file(file)
-    if warnings:
-        for warning in warnings:
-            st.warning(warning)
-    return content
+    """
+    Read and validate an uploaded file, reusing the result until a different file is uploaded.
+    
+    The decoded content and its warnings are kept in st.session_state["uploaded_code"]
+    so reruns don't decode and re-validate the same upload again.
+    """
+    cache = st.session_state.setdefault("uploaded_code", {})
+    file_key = upload_key(file)
+    cached = cache.get(file_key)
+    if cached is None:
+        content, warnings = validate_and_read_code_file(file)
+        cached = {"content": content, "warnings": warnings}
+        # A syntax check that couldn't run (e.g. a timeout on a busy machine) is retried on the next rerun
+        if not any(warning.startswith(SYNTAX_CHECK_SKIPPED) for warning in warnings):
+            cache[file_key] = cached
+
+    for warning in cached["warnings"]:
+        st.warning(warning)
+    return cached["content"]
 
-def safe_llm_invoke(llm_instance, messages, max_retries: int = 3, retry_delay: float = 1.0):
+STREAM_RENDER_INTERVAL = 0.1  # Seconds between redraws of a streaming response
+
+def safe_llm_invoke(llm_instance, messages, placeholder=None, total_len: Optional[int] = None, max_retries: int = 3, retry_delay: float = 1.0):
     """
     Safely invoke LLM with error handling and retry logic.
     
     Args:
         llm_instance: The ChatOllama instance
         messages: List of messages to send to the model
+        placeholder: Optional st.empty() placeholder; when given, the response is
+            streamed and rendered into it token by token
+        total_len: Combined length of the message contents, if the caller already
+            knows it; otherwise it is computed once on the first attempt
         max_retries: Maximum number of retry attempts
         retry_delay: Delay between retry attempts in seconds
         
@@ -211,12 +553,26 @@ def safe_llm_invoke(llm_instance, messages, max_retries: int = 3, retry_delay: f
                 raise ValueError("Messages must be a non-empty list")
             
             # Check for reasonable message sizes
-            total_content_length = sum(len(msg.content) for msg in messages if hasattr(msg, 'content'))
-            if total_content_length > 50000:  # ~50KB limit
+            if total_len is None:
+                total_len = sum(len(msg.content) for msg in messages if hasattr(msg, 'content'))
+            if total_len > 50000:  # ~50KB limit
                 st.warning("Input is very large and may cause issues. Consider using smaller code snippets.")
             
-            # Make the API call
-            response = llm_instance.invoke(messages)
+            # Make the API call, streaming into the placeholder when one is given
+            if placeholder is not None:
+                acc = []
+                last_render = 0.0
+                for chunk in llm_instance.stream(messages):
+                    acc.append(chunk.content)
+                    # Redraw at most every STREAM_RENDER_INTERVAL seconds rather than per token
+                    now = time.monotonic()
+                    if now - last_render >= STREAM_RENDER_INTERVAL:
+                        placeholder.markdown("".join(acc))
+                        last_render = now
+                response = AIMessage(content="".join(acc))
+                placeholder.markdown(response.content)
+            else:
+                response = llm_instance.invoke(messages)
             
             # Validate response
             if not response or not hasattr(response, 'content') or not response.content:
@@ -238,11 +594,12 @@ def safe_llm_invoke(llm_instance, messages, max_retries: int = 3, retry_delay: f
             
         except Exception as e:
             error_msg = str(e)
-            if attempt < max_retries - 1:
+            # Only connection problems are worth retrying; anything else fails the same way again
+            if attempt < max_retries - 1 and isinstance(e, _RETRYABLE):
                 st.warning(f"Attempt {attempt + 1} failed: {error_msg}. Retrying in {retry_delay} seconds...")
                 time.sleep(retry_delay)
             else:
-                st.error(f"Failed to get response after {max_retries} attempts: {error_msg}")
+                st.error(f"Failed to get response after {attempt + 1} attempts: {error_msg}")
                 
                 # Provide helpful error messages based on error type
                 if "connection" in error_msg.lower() or "timeout" in error_msg.lower():
@@ -256,9 +613,196 @@ def safe_llm_invoke(llm_instance, messages, max_retries: int = 3, retry_delay: f
     
     return None
 
+# ========== Response Caching ==========
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # Seconds a cached response stays valid in memory
+RESPONSE_CACHE_MAX_ENTRIES = 128
+RESPONSE_CACHE_DIR = os.path.join(FILES_DIR, "llm_cache")
+RESPONSE_CACHE_DISK_TTL = 7 * 24 * 60 * 60  # Seconds a response persists on disk
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache of model responses with a time-to-live.
+    
+    When a diskcache.Cache is given, responses are also persisted there so they
+    survive app restarts; the in-memory LRU stays in front of it.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, disk=None, disk_ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk = disk
+        self.disk_ttl = disk_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, content = entry
+                if time.time() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    return content
+                del self._entries[key]
+        if self.disk is None:
+            return None
+        content = self.disk.get(key)
+        if content is not None:
+            self._remember(key, content)
+        return content
+
+    def set(self, key: str, content: str) -> None:
+        self._remember(key, content)
+        if self.disk is not None:
+            self.disk.set(key, content, expire=self.disk_ttl)
+
+    def _remember(self, key: str, content: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> ResponseCache:
+    """Return the response cache shared by all sessions, persisted to disk when diskcache is installed."""
+    disk = diskcache.Cache(RESPONSE_CACHE_DIR) if diskcache is not None else None
+    return ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, disk=disk, disk_ttl=RESPONSE_CACHE_DISK_TTL)
+
+_RESPONSE_CACHE_NAMESPACE = json.dumps([OLLAMA_MODEL, OLLAMA_OPTIONS], sort_keys=True).encode("utf-8")
+
+def response_cache_key(system_prompt: str, user_message: str) -> str:
+    """Hash the exact prompt pair sent to the model, along with the model and its sampling options."""
+    digest = hashlib.sha256()
+    # Persisted entries must not be served after OLLAMA_MODEL or OLLAMA_OPTIONS change
+    digest.update(_RESPONSE_CACHE_NAMESPACE)
+    digest.update(b"\0")
+    digest.update(system_prompt.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(user_message.encode("utf-8"))
+    return digest.hexdigest()
+
+def cached_llm_invoke(llm_instance, system_prompt: str, user_message: str, placeholder=None):
+    """
+    Invoke the model through safe_llm_invoke, reusing the response for identical prompts.
+    
+    Args:
+        llm_instance: The ChatOllama instance
+        system_prompt: System prompt sent as the SystemMessage
+        user_message: Prompt sent as the HumanMessage
+        placeholder: Optional st.empty() placeholder to stream the response into
+        
+    Returns:
+        tuple: (model response or None if all attempts fail, whether it came from the cache)
+    """
+    cache = get_response_cache()
+    key = response_cache_key(system_prompt, user_message)
+    cached = cache.get(key)
+    if cached is not None:
+        return AIMessage(content=cached), True
+
+    messages = [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=user_message)
+    ]
+    response = safe_llm_invoke(
+        llm_instance, messages, placeholder=placeholder, total_len=len(system_prompt) + len(user_message)
+    )
+    if response:
+        cache.set(key, response.content)
+    return response, False
+
+async def safe_llm_ainvoke(client, system_prompt: str, user_message: str, max_retries: int = 3, retry_delay: float = 1.0) -> str:
+    """
+    Send one chat request through the Ollama AsyncClient with retry logic.
+    
+    Args:
+        client: ollama.AsyncClient bound to the running event loop
+        system_prompt: System prompt sent as the system message
+        user_message: Prompt sent as the user message
+        max_retries: Maximum number of attempts
+        retry_delay: Delay between retry attempts in seconds
+        
+    Returns:
+        The response text; the last error is raised if every attempt fails
+    """
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message},
+    ]
+    for attempt in range(max_retries):
+        try:
+            response = await client.chat(
+                model=OLLAMA_MODEL, messages=messages, options=OLLAMA_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE
+            )
+            content = response["message"]["content"]
+            if not content:
+                raise ValueError("Received empty response from model")
+            return content
+        except _RETRYABLE:
+            if attempt == max_retries - 1:
+                raise
+            await asyncio.sleep(retry_delay)
+
+def invoke_concurrently(system_prompt: str, user_messages: list[str]) -> tuple[list, int]:
+    """
+    Send several prompts to the model at once so total latency is close to the slowest one.
+    
+    Cached responses are reused and only the misses are sent to Ollama. Requests
+    only run in parallel when Ollama is started with OLLAMA_NUM_PARALLEL > 1.
+    
+    Args:
+        system_prompt: System prompt shared by every request
+        user_messages: Prompts to send, one request each
+        
+    Returns:
+        tuple: (list aligned with user_messages holding the response text or the
+        exception raised for that request, number of responses served from the cache)
+    """
+    cache = get_response_cache()
+    keys = [response_cache_key(system_prompt, message) for message in user_messages]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    cache_hits = len(results) - len(missing)
+
+    async def _gather():
+        # The async connection pool is bound to the event loop that created it,
+        # so each asyncio.run gets its own client.
+        client = ollama.AsyncClient(host=OLLAMA_HOST)
+        return await asyncio.gather(
+            *(safe_llm_ainvoke(client, system_prompt, user_messages[i]) for i in missing),
+            return_exceptions=True
+        )
+
+    if missing:
+        for i, response in zip(missing, asyncio.run(_gather())):
+            results[i] = response
+            if not isinstance(response, BaseException):
+                cache.set(keys[i], response)
+    return results, cache_hits
+
+# CodeLlama's tokenizer.json (from codellama/CodeLlama-7b-Instruct-hf on the Hugging Face Hub)
+TOKENIZER_FILE = os.path.join(FILES_DIR, "tokenizer.json")
+
+@st.cache_resource(show_spinner=False)
+def get_tokenizer():
+    """
+    Load the CodeLlama tokenizer from TOKENIZER_FILE once per process, or return None if unavailable.
+    
+    Only the local file is used, so counting never waits on the network.
+    """
+    if tokenizers is None or not os.path.exists(TOKENIZER_FILE):
+        return None
+    try:
+        return tokenizers.Tokenizer.from_file(TOKENIZER_FILE)
+    except Exception:
+        # Unreadable or incompatible file; fall back to the heuristic
+        return None
+
+@st.cache_data(max_entries=128, show_spinner=False)
 def estimate_token_count(text: str) -> int:
     """
-    Estimate token count for input text (rough approximation).
+    Count tokens for input text, exactly when the model tokenizer is available.
     
     Args:
         text: Input text to estimate tokens for
@@ -266,10 +810,31 @@ def estimate_token_count(text: str) -> int:
     Returns:
         Estimated number of tokens
     """
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
     # Rough estimation: 1 token ≈ 4 characters for English text
     # This is a conservative estimate for code which may have more tokens
     return len(text) // 3
 
+# Prompt tokens allowed in the num_ctx window, leaving room for the model's reply
+REPLY_TOKEN_BUDGET = 512
+MAX_PROMPT_TOKENS = OLLAMA_OPTIONS["num_ctx"] - REPLY_TOKEN_BUDGET
+
+def check_prompt_length(system_prompt: str, user_message: str, label: Optional[str] = None) -> None:
+    """
+    Raise ValueError if the system prompt plus the user message won't fit in MAX_PROMPT_TOKENS.
+    
+    Checking before dispatch fails fast instead of spending a full round-trip on a request Ollama would truncate.
+    """
+    prompt_tokens = estimate_token_count(system_prompt) + estimate_token_count(user_message)
+    if prompt_tokens > MAX_PROMPT_TOKENS:
+        prefix = f"{label}: " if label is not None else ""
+        raise ValueError(
+            f"{prefix}Prompt too large: ~{prompt_tokens} tokens including the system prompt (max: {MAX_PROMPT_TOKENS}). "
+            "Please use smaller code snippets or a shorter system prompt."
+        )
+
 def validate_code_input(code: str, user_prompt: str = "") -> tuple[bool, list[str]]:
     """
     Validate code input for size, format, and potential issues.
@@ -291,113 +856,228 @@ def validate_code_input(code: str, user_prompt: str = "") -> tuple[bool, list[st
     total_text = code + user_prompt
     estimated_tokens = estimate_token_count(total_text)
     
-    # Token limits based on model context window
-    MAX_TOKENS = 3000  # Conservative limit for 4K context window
-    WARN_TOKENS = 2000  # Warning threshold
-    
     if estimated_tokens > MAX_TOKENS:
         return False, [f"Input too large: ~{estimated_tokens} tokens (max: {MAX_TOKENS}). Please use smaller code snippets."]
     elif estimated_tokens > WARN_TOKENS:
         warnings.append(f"Large input detected: ~{estimated_tokens} tokens. Consider using smaller code snippets for better results.")
     
-    # Check for very long lines
     if code:
-        lines = code.split('\n')
-        long_lines = [i+1 for i, line in enumerate(lines) if len(line) > 200]
+        lines, long_lines = _scan_lines(code, 200)
+        
+        # Check for very long lines
         if len(long_lines) > 5:
             warnings.append(f"Many long lines detected (>200 chars). This may affect code analysis quality.")
-    
-    # Check for excessive repetition (potential copy-paste errors)
-    if code:
-        lines = code.split('\n')
-        unique_lines = set(line.strip() for line in lines if line.strip())
-        if len(lines) > 50 and len(unique_lines) < len(lines) * 0.5:
+        
+        # Check for excessive repetition (potential copy-paste errors)
+        if len(lines) > 50 and _is_repetitive(lines):
             warnings.append("High repetition detected in code. Please check for copy-paste errors.")
     
     # Basic Python syntax validation for code input
     if code.strip():
-        try:
-            compile(code, '<string>', 'exec')
-        except SyntaxError as e:
-            warnings.append(f"Python syntax error detected: {str(e)}")
+        warning = syntax_warning(code, '<string>')
+        if warning:
+            warnings.append(warning)
     
     return True, warnings
 
 # --- ENHANCED build_prompt function (No Multi-line Strings) ---
+# Prompt templates are assembled once at import time so build_prompt is a single format call.
+_DIRECT_WITH_CODE_TMPL = "{user_prompt}\n\n```python\n{code}\n```"
+_EXPLAIN_TMPL = "Explain the following Python code:\n\n```python\n{code}\n```"
+_DEBUG_TMPL = "Analyze and debug the following Python code:\n\n```python\n{code}\n```"
+_REFACTOR_TMPL = (
+    "Please refactor the following Python code. Your primary goals are to improve: {focus_str}.\n"
+    "First, provide an explanation of the changes made and why they improve the code.\n"
+    "Then, provide the complete, revised Python code block with concise inline comments (#) for significant changes.\n\n"
+    "Original Code:\n"
+    "```python\n"
+    "{code}"
+    "\n```\n\n"
+    "Explanation and Refactored Code:\n"  # New guide
+)
+_DEFAULT_REFACTOR_FOCUS = "clarity, maintainability, performance"
+
+def _build_explain(code=None, refactor_focus_areas=None):
+    return _EXPLAIN_TMPL.format(code=code)
+
+def _build_refactor(code=None, refactor_focus_areas=None):
+    # Provides default focus areas if none are specified.
+    if refactor_focus_areas is None:
+        focus_str = _DEFAULT_REFACTOR_FOCUS
+    else:
+        focus_str = ", ".join(refactor_focus_areas)
+    return _REFACTOR_TMPL.format(focus_str=focus_str, code=code)
+
+def _build_debug(code=None, refactor_focus_areas=None):
+    return _DEBUG_TMPL.format(code=code)
+
+def _build_unknown(**_):
+    return ""
+
+_BUILDERS = {
+    "Explain": _build_explain,
+    "Refactor": _build_refactor,
+    "Debug": _build_debug,
+}
+
+@st.cache_data(max_entries=32, show_spinner=False)
 def build_prompt(task, code=None, user_prompt=None, refactor_focus_areas=None):
     """
     Builds the prompt for the LLM based on the selected task or direct input.
     Uses enhanced, structured prompts for Explain, Refactor, and Debug.
+    Results are cached across reruns with st.cache_data, keyed on the arguments' contents.
     """
     if user_prompt:  # Direct Prompt mode
         # The SystemMessage will be added separately when invoking the LLM
-        return f"{user_prompt}\n\n```python\n{code}\n```" if code else user_prompt
-
-    elif task == "Explain":
-        prompt = "Explain the following Python code:\n\n"
-        prompt += "```python\n"
-        prompt += code
-        prompt += "\n```"
-        return prompt
-
-    elif task == "Refactor":
-        # Provides default focus areas if none are specified.
-        if refactor_focus_areas is None:
-            refactor_focus_areas = ["clarity", "maintainability", "performance"]
-        focus_str = ", ".join(refactor_focus_areas)
+        return _DIRECT_WITH_CODE_TMPL.format(user_prompt=user_prompt, code=code) if code else user_prompt
 
-        prompt = f"Please refactor the following Python code. Your primary goals are to improve: {focus_str}.\n"
-        prompt += "First, provide an explanation of the changes made and why they improve the code.\n"
-        prompt += "Then, provide the complete, revised Python code block with concise inline comments (#) for significant changes.\n\n"
-        prompt += "Original Code:\n"
-        prompt += "```python\n"
-        prompt += code
-        prompt += "\n```\n\n"
-        prompt += "Explanation and Refactored Code:\n" # New guide
-        return prompt
-
-    elif task == "Debug":
-        prompt = "Analyze and debug the following Python code:\n\n"
-        prompt += "```python\n"
-        prompt += code
-        prompt += "\n```"
-        return prompt
-        
-    return ""
+    return _BUILDERS.get(task, _build_unknown)(code=code, refactor_focus_areas=refactor_focus_areas)
+
+# --- Multi-task prompt: one request covering several Structured tasks ---
+STRUCTURED_TASKS = ("Explain", "Refactor", "Debug")
+_MULTI_TASK_INSTRUCTIONS = {
+    "Explain": "Explain the code: its purpose, key components, inputs and outputs, and notable edge cases.",
+    "Refactor": (
+        "Refactor the code to improve: " + _DEFAULT_REFACTOR_FOCUS + ". "
+        "First explain the changes and why they improve the code, then provide the complete, "
+        "revised Python code block with concise inline comments (#) for significant changes."
+    ),
+    "Debug": "Debug the code: list each bug or issue and why it is a problem, propose fixes, then provide the corrected code.",
+}
+_MULTI_TASK_HEADER_TMPL = (
+    "Perform each of the following tasks on the Python code below, in the order given. "
+    "Start each section with its marker (for example <<<{first}>>>) alone on its own line, "
+    "exactly as written, followed by your answer for that task.\n\n"
+)
+_SECTION_MARKER_RE = re.compile(r"<<<(\w+)>>>")
+
+def section_marker(task: str) -> str:
+    return f"<<<{task.upper()}>>>"
+
+def build_prompt_multi(tasks, code: str) -> str:
+    """
+    Build one prompt asking for several Structured tasks on the same code.
+    
+    The code block is sent (and prefilled by the model) once instead of once per task.
+    Each answer is introduced by a marker like <<<EXPLAIN>>>; see split_multi_response().
+    """
+    parts = [_MULTI_TASK_HEADER_TMPL.format(first=tasks[0].upper())]
+    for task in tasks:
+        parts.append(f"{section_marker(task)}\n{_MULTI_TASK_INSTRUCTIONS[task]}\n\n")
+    parts.append(f"Code:\n```python\n{code}\n```")
+    return "".join(parts)
+
+def split_multi_response(text: str, tasks) -> dict[str, str]:
+    """Split a build_prompt_multi() response into {task: section text} using its markers."""
+    tasks_by_marker = {task.upper(): task for task in tasks}
+    parts = _SECTION_MARKER_RE.split(text)
+    sections = {}
+    # parts alternates [preamble, marker, body, marker, body, ...]
+    for marker, body in zip(parts[1::2], parts[2::2]):
+        task = tasks_by_marker.get(marker.upper())
+        if task is not None and body.strip():
+            sections[task] = body.strip()
+    return sections
+
+def format_multi_response(text: str, tasks) -> str:
+    """Render a multi-task response as one Markdown section per task."""
+    sections = split_multi_response(text, tasks)
+    if not sections:
+        # The model ignored the markers; show its answer as is
+        return text
+    return "\n\n".join(
+        f"#### {task}\n\n{sections.get(task, '_The model did not return this section._')}"
+        for task in tasks
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_io_executor() -> ThreadPoolExecutor:
+    """Worker for disk writes, shared across reruns so saving never blocks the UI."""
+    # A single worker keeps appends to the output log in submission order
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="save_output")
+
+OUTPUT_LOG_FILE = os.path.join(FILES_DIR, "outputs.jsonl")
+
+def _do_save(input_data, result, timestamp):
+    record = {"ts": timestamp, "input": input_data, "response": result}
+    if orjson is not None:
+        line = orjson.dumps(record) + b"\n"
+    else:
+        line = json.dumps(record).encode("utf-8") + b"\n"
+    # Unbuffered O_APPEND write: the whole record goes to the end of the log in one syscall
+    fd = os.open(OUTPUT_LOG_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        view = memoryview(line)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
 
 def save_output(input_data, result):
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_file = os.path.join(FILES_DIR, f"output_{timestamp}.json")
-    with open(out_file, "w") as f:
-        json.dump({"input": input_data, "response": result}, f, indent=2)
+    """Append the interaction to the output log in the background; failures are reported on the next rerun."""
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    future = get_io_executor().submit(_do_save, input_data, result, timestamp)
+    st.session_state.setdefault("pending_saves", []).append(future)
+    return future
+
+def report_failed_saves():
+    """Show a warning for any background save that failed since the last rerun."""
+    pending = []
+    for future in st.session_state.get("pending_saves", []):
+        if not future.done():
+            pending.append(future)
+        elif future.exception() is not None:
+            st.warning(f"Could not save output: {future.exception()}")
+    st.session_state.pending_saves = pending
 
-def get_base64_image(image_path):
+@st.cache_data(show_spinner=False)
+def get_base64_image(image_path, mtime=None):
+    """Base64-encode an image; mtime is only part of the cache key so edits to the file invalidate it."""
     with open(image_path, "rb") as f:
         data = f.read()
     return base64.b64encode(data).decode()
 
+@st.cache_data(show_spinner=False)
+def get_header_html(image_path: str, mtime: float) -> str:
+    """Fill the header template with the logo once per logo version; mtime only keys the cache."""
+    return _HEADER_TMPL.format(logo_base64=get_base64_image(image_path, mtime))
+
+@st.cache_data(show_spinner=False)
+def _build_font_css(font_mtimes: tuple) -> str:
+    """Inline the local Montserrat files as @font-face rules; font_mtimes only keys the cache."""
+    faces = []
+    for weight, file_name in _MONTSERRAT_FONT_FILES.items():
+        with open(os.path.join(FONTS_DIR, file_name), "rb") as f:
+            font_base64 = base64.b64encode(f.read()).decode()
+        faces.append(_FONT_FACE_TMPL.format(weight=weight, data=font_base64))
+    return "<style>\n" + "\n".join(faces) + "\n</style>"
+
+def get_font_css() -> str:
+    """Return @font-face rules for the local Montserrat files, or the Google Fonts import if any are missing."""
+    try:
+        font_mtimes = tuple(
+            os.path.getmtime(os.path.join(FONTS_DIR, file_name)) for file_name in _MONTSERRAT_FONT_FILES.values()
+        )
+        return _build_font_css(font_mtimes)
+    except FileNotFoundError:
+        return _REMOTE_FONT_CSS
+
 # ========== Streamlit UI ==========
-st.set_page_config(layout="wide") # Use wide layout for better code display
 
 # Logo and Title Header
 logo_path = os.path.join(FILES_DIR, "logo.jpg")
-if os.path.exists(logo_path):
-    try:
-        logo_base64 = get_base64_image(logo_path)
-        st.markdown(
-            f"""
-            <div style='display: flex; align-items: center; gap: 1rem; margin-bottom: 1.5rem;'>
-                <img src='data:image/jpeg;base64,{logo_base64}' style='vertical-align: middle;' width='50'>
-                <h1 style='margin: 0; font-family: Montserrat, sans-serif; color: #2D2042;'>Local Python Code Assistant with Codellama:7b-instruct</h1>
-            </div>
-            """,
-            unsafe_allow_html=True
-        )
-    except Exception as e:
-        st.warning(f"Could not load logo: {e}")
-        st.title("Local Python Code Assistant with Codellama:7b-instruct")
-else:
+try:
+    header_html = get_header_html(logo_path, os.path.getmtime(logo_path))
+except FileNotFoundError:
+    header_html = None
+except Exception as e:
+    st.warning(f"Could not load logo: {e}")
+    header_html = None
+
+if header_html is None:
     st.title("Local Python Code Assistant with Codellama:7b-instruct")
+else:
+    st.markdown(header_html, unsafe_allow_html=True)
 
 
 st.sidebar.header("✨ Interaction Mode ✨")
@@ -405,168 +1085,238 @@ mode = st.sidebar.radio("Choose a mode:", ["Structured", "Direct Prompt"])
 save_toggle = st.sidebar.checkbox("Save output to file", value=False)
 
 # Initialize session state for response storage
-if 'last_response' not in st.session_state:
-    st.session_state.last_response = None
-if 'last_response_metadata' not in st.session_state:
-    st.session_state.last_response_metadata = {}
+st.session_state.setdefault("last_response", None)
+st.session_state.setdefault("last_response_metadata", {})
+
+report_failed_saves()
 
 
 # Apply base styling
-st.markdown(get_base_css(), unsafe_allow_html=True)
+st.markdown(get_font_css(), unsafe_allow_html=True)
+st.markdown(_BASE_CSS, unsafe_allow_html=True)
 
 st.sidebar.markdown("---")
 
-# --- ENHANCED System Prompt ---
-new_def_prompt = """
-You are a helpful and concise AI code assistant. Your primary goal is to analyze user-submitted Python code and respond accurately and effectively based on the specified task.
+# --- Styled System Prompt Section ---
+st.sidebar.markdown(_SIDEBAR_SYS_PROMPT_BLURB_HTML, unsafe_allow_html=True)
 
-- **Explaining Code**:
-  Provide a clear and beginner-friendly explanation. Your explanation should cover:
-  1. The overall purpose and functionality of the code.
-  2. A breakdown of key components (functions, classes, significant logic blocks).
-  3. The expected input(s) and output(s).
-  4. Any potential edge cases or notable behaviors you observe.
-  Be thorough yet concise.
+@st.fragment
+def render_system_prompt():
+    """System prompt editor; edits rerun only this fragment and are read at request time."""
+    # Use the new prompt as the default
+    st.text_area(
+        "System Prompt",
+        value=_DEFAULT_SYS_PROMPT,
+        height=350, # Increased height
+        key="custom_sys_prompt",
+        label_visibility="collapsed"
+    )
 
-- **Refactoring Code**:
-  Your goal is to improve the code based on specified focus areas (e.g., clarity, maintainability, performance, Pythonic idioms).
-  Please provide:
-  1. A clear explanation of the changes you made and the reasoning behind them.
-  2. The complete, revised Python code block.
-  3. Ensure the code block includes concise inline comments (`#`) for significant changes.
-  Ensure the refactored code remains functionally equivalent to the original.
+with st.sidebar:
+    render_system_prompt()
 
-- **Debugging Code**:
-  Analyze the code for bugs, errors, and potential issues. Present your findings in a structured manner:
-  1.  **Bug Identification**: Clearly list each bug or issue found. Explain *why* it is an issue (e.g., syntax error, logical flaw, runtime risk, deviation from best practices).
-  2.  **Proposed Fixes**: For each identified bug, describe the necessary changes to correct it.
-  3.  **Corrected Code**: Provide the complete Python code block with all identified bugs fixed.
+# --- Main Area Layout ---
+def run_pending_request(request, system_prompt, save_toggle):
+    """Run a request queued by the input controls, streaming the response into the current container."""
+    # Show warnings
+    for warning in request["warnings"]:
+        st.warning(warning)
 
-Always use Markdown for formatting your response. Code blocks must be enclosed in triple backticks (```python ... ```).
-"""
+    prompts = request["prompts"]
+    # The system prompt is only known here, so the context-window check happens right before dispatch
+    try:
+        for label, prompt in prompts:
+            check_prompt_length(system_prompt, prompt, label)
+    except ValueError as e:
+        st.error(str(e))
+        return
+    if len(prompts) == 1:
+        stream_placeholder = st.empty()
+        with st.spinner("Generating model response..."):
+            response, cache_hit = cached_llm_invoke(llm, system_prompt, prompts[0][1], placeholder=stream_placeholder)
+        cache_hits = int(cache_hit)
+        # The final text is drawn by render_response()
+        stream_placeholder.empty()
+        response_text = response.content if response else None
+        if response_text and request.get("tasks"):
+            response_text = format_multi_response(response_text, request["tasks"])
+    elif llm is None:
+        st.error("Model is not initialized. Please restart the application.")
+        response_text = None
+        cache_hits = 0
+    else:
+        with st.spinner(f"Generating model responses for {len(prompts)} files..."):
+            results, cache_hits = invoke_concurrently(system_prompt, [prompt for _, prompt in prompts])
+        sections = []
+        for (label, _), result in zip(prompts, results):
+            if isinstance(result, BaseException):
+                st.error(f"Failed to get response for {label}: {result}")
+                result = "_No response from model._"
+            elif request.get("tasks"):
+                result = format_multi_response(result, request["tasks"])
+            sections.append(f"### {label}\n\n{result}")
+        response_text = "\n\n---\n\n".join(sections)
 
-# --- Styled System Prompt Section ---
-st.sidebar.markdown("""
-    <div style='border: 1px solid #e6e6e6; padding: 12px; border-radius: 8px; background-color: #f9f9f9; margin-top: 10px; margin-bottom: 20px;'>
-        <strong style='color: #2D2042;'>System Prompt</strong><br>
-        <small style='color: #666;'>Customize how the model behaves. Use markdown-friendly formatting.</small>
-    </div>
-""", unsafe_allow_html=True)
+    if response_text:
+        st.session_state.last_response = response_text
+        st.session_state.last_response_metadata = {
+            **request["input_data"],
+            "cache_hits": cache_hits,
+            "cache_misses": len(prompts) - cache_hits,
+        }
+        if cache_hits == len(prompts):
+            st.caption("Served from the response cache.")
 
-# Use the new prompt as the default
-custom_sys_prompt = st.sidebar.text_area("", value=new_def_prompt, height=350) # Increased height
+        if save_toggle:
+            save_output(request["input_data"], response_text)
+    else:
+        st.error("Failed to get response from model. Please try again.")
 
-# --- Main Area Layout ---
-col1, col2 = st.columns(2)
+def validate_code_units(code_units, user_prompt=""):
+    """Validate each (label, code) unit, stopping the run with errors if any is invalid."""
+    all_warnings = []
+    for label, unit_code in code_units:
+        is_valid, validation_warnings = validate_code_input(unit_code, user_prompt)
+        if label is not None:
+            validation_warnings = [f"{label}: {warning}" for warning in validation_warnings]
+        
+        if not is_valid:
+            for warning in validation_warnings:
+                st.error(warning)
+            st.stop()
+        all_warnings.extend(validation_warnings)
+    return all_warnings
 
-with col1:
+def describe_code_units(code_units):
+    """Describe the submitted code for saved output and response metadata."""
+    if len(code_units) == 1:
+        return {"code": code_units[0][1]}
+    return {"files": [{"name": label, "code": unit_code} for label, unit_code in code_units]}
+
+@st.fragment
+def render_inputs(mode):
+    """Code input and controls; interacting with these widgets reruns only this fragment."""
     st.subheader("Input Code")
     # --- Upload or paste code ---
-    uploaded_file = st.file_uploader("Upload a code file:", type=["py", "js", "java"])
+    uploaded_files = st.file_uploader("Upload code files:", type=["py", "js", "java"], accept_multiple_files=True)
     code_input = st.text_area("Or paste your code here:", height=300)
 
-    code = ""
-    if uploaded_file:
-        code = read_code_file(uploaded_file)
-        # Display the loaded code
-        st.code(code, language='python') # Show uploaded code
-    elif code_input.strip():
-        code = code_input
+    # Each unit is (file name or None for pasted code, code); uploads take precedence
+    code_units = []
+    if uploaded_files:
+        for uploaded_file in uploaded_files:
+            file_code = read_code_file(uploaded_file)
+            # Display the loaded code
+            if len(uploaded_files) > 1:
+                st.caption(uploaded_file.name)
+            st.code(file_code, language='python') # Show uploaded code
+            code_units.append((uploaded_file.name, file_code))
+        if len(uploaded_files) > 1:
+            st.caption("Files are sent to Ollama concurrently. Start Ollama with OLLAMA_NUM_PARALLEL=4 to process them in parallel.")
+        # Forget files that have been removed from the uploader
+        current_keys = {upload_key(uploaded_file) for uploaded_file in uploaded_files}
+        st.session_state.uploaded_code = {
+            key: value for key, value in st.session_state.uploaded_code.items() if key in current_keys
+        }
+    else:
+        st.session_state.pop("uploaded_code", None)
+        if code_input.strip():
+            code_units.append((None, code_input))
+    code_units = [(label, unit_code) for label, unit_code in code_units if unit_code]
 
     # --- Prompt Execution ---
     st.subheader("Controls")
     if mode == "Structured":
-        task = st.radio("What do you want to do?", ["Explain", "Refactor", "Debug"])
+        task = st.radio("What do you want to do?", list(STRUCTURED_TASKS))
         # Future enhancement: Add checkboxes here for refactor_focus_areas
-        if st.button("Run Analysis", use_container_width=True):
-            if not code:
+        run_selected = st.button("Run Analysis", use_container_width=True)
+        # One request for every task, so the code is only sent and prefilled once
+        run_all = st.button("Run all three", use_container_width=True)
+        if run_selected or run_all:
+            if not code_units:
                 st.error("Please upload or enter some code.")
             else:
                 # Validate input before processing
-                is_valid, validation_warnings = validate_code_input(code)
-                
-                if not is_valid:
-                    for warning in validation_warnings:
-                        st.error(warning)
-                    st.stop()
+                validation_warnings = validate_code_units(code_units)
                 
-                # Show warnings
-                for warning in validation_warnings:
-                    st.warning(warning)
-                
-                with st.spinner("Generating model response..."):
-                    final_prompt = build_prompt(task, code) # Using new build_prompt
-                    messages = [
-                        SystemMessage(content=custom_sys_prompt), # Using potentially customized system prompt
-                        HumanMessage(content=final_prompt)
-                    ]
-                    response = safe_llm_invoke(llm, messages)
-
-                if response:
-                    st.session_state.last_response = response.content
-                    st.session_state.last_response_metadata = {
-                        "mode": mode,
-                        "task": task,
-                        "code": code
-                    }
-
-                    if save_toggle:
-                        save_output({"mode": mode, "task": task, "code": code}, response.content)
+                if run_all:
+                    input_data = {"mode": mode, "tasks": list(STRUCTURED_TASKS), **describe_code_units(code_units)}
+                    prompts = [(label, build_prompt_multi(STRUCTURED_TASKS, unit_code)) for label, unit_code in code_units]
                 else:
-                    st.error("Failed to get response from model. Please try again.")
+                    input_data = {"mode": mode, "task": task, **describe_code_units(code_units)}
+                    # Using new build_prompt
+                    prompts = [(label, build_prompt(task, unit_code)) for label, unit_code in code_units]
+                
+                st.session_state.pending_request = {
+                    "input_data": input_data,
+                    "prompts": prompts,
+                    "tasks": STRUCTURED_TASKS if run_all else None,
+                    "warnings": validation_warnings,
+                }
+                # The response pane lives outside this fragment, so rerun the whole app
+                st.rerun(scope="app")
 
 
     elif mode == "Direct Prompt":
         user_prompt = st.text_area("Enter your custom prompt:", height=100)
         if st.button("Run Prompt", use_container_width=True):
-            if not user_prompt.strip() and not code.strip():
+            if not user_prompt.strip() and not code_units:
                 st.error("Please enter a prompt or provide some code.")
             else:
                 # Validate input before processing
-                is_valid, validation_warnings = validate_code_input(code if code else "", user_prompt)
-                
-                if not is_valid:
-                    for warning in validation_warnings:
-                        st.error(warning)
-                    st.stop()
+                units = code_units or [(None, "")]
+                validation_warnings = validate_code_units(units, user_prompt)
                 
-                # Show warnings
-                for warning in validation_warnings:
-                    st.warning(warning)
-                
-                with st.spinner("Generating model response..."):
-                    final_prompt = build_prompt(None, code if code else None, user_prompt)
-                    messages = [
-                        SystemMessage(content=custom_sys_prompt), # Ensure system prompt is always used
-                        HumanMessage(content=final_prompt)
-                    ]
-                    response = safe_llm_invoke(llm, messages)
-
-                if response:
-                    st.session_state.last_response = response.content
-                    st.session_state.last_response_metadata = {
-                        "mode": mode,
-                        "prompt": user_prompt,
-                        "code": code
-                    }
-
-                    if save_toggle:
-                        save_output({"mode": mode, "prompt": user_prompt, "code": code}, response.content)
-                else:
-                    st.error("Failed to get response from model. Please try again.")
+                st.session_state.pending_request = {
+                    "input_data": {"mode": mode, "prompt": user_prompt, **describe_code_units(units)},
+                    "prompts": [
+                        (label, build_prompt(None, unit_code if unit_code else None, user_prompt))
+                        for label, unit_code in units
+                    ],
+                    "warnings": validation_warnings,
+                }
+                # The response pane lives outside this fragment, so rerun the whole app
+                st.rerun(scope="app")
+
+# Longer responses are rendered as markdown only up to this many characters
+RESPONSE_DISPLAY_LIMIT = 200_000
+
+@st.fragment
+def render_response():
+    """
+    Render the last model response.
+    
+    Reruns of the input and system prompt fragments don't reach this fragment,
+    so the (potentially large) response is only re-sent on full app reruns.
+    """
+    last = st.session_state.get("last_response")
+    if last is None:
+        st.info("The model's response will appear here.")
+        return
+    if len(last) <= RESPONSE_DISPLAY_LIMIT:
+        # Use st.markdown for rich text rendering including code blocks
+        st.markdown(last, unsafe_allow_html=True)
+        return
+    # Only the head goes through markdown; the rest is shown verbatim, and no part is sent twice
+    st.markdown(last[:RESPONSE_DISPLAY_LIMIT], unsafe_allow_html=True)
+    st.caption(f"Showing the first {RESPONSE_DISPLAY_LIMIT:,} of {len(last):,} characters.")
+    with st.expander("Show the rest"):
+        st.code(last[RESPONSE_DISPLAY_LIMIT:], language=None)
+
+col1, col2 = st.columns(2)
+
+with col1:
+    render_inputs(mode)
 
 with col2:
     st.subheader("Model Response")
-    # Display the last response with scrollable view
-    if st.session_state.last_response is not None:
-        # Use st.markdown for rich text rendering including code blocks
-        st.markdown(st.session_state.last_response, unsafe_allow_html=True)
-    else:
-        st.info("The model's response will appear here.")
+    pending_request = st.session_state.pop("pending_request", None)
+    if pending_request is not None:
+        # Ensure system prompt is always used
+        custom_sys_prompt = st.session_state.get("custom_sys_prompt", _DEFAULT_SYS_PROMPT)
+        run_pending_request(pending_request, custom_sys_prompt, save_toggle)
+    render_response()
 
 
 # Footer Branding - placed at the bottom, outside columns
-st.markdown("""
-    <hr style='margin-top: 3rem;'>
-    <div style='text-align: center; color: #2D2042;'>Smarter Paths Forward</div>
-""", unsafe_allow_html=True)
\ No newline at end of file
+st.markdown(_FOOTER_HTML, unsafe_allow_html=True)
\ No newline at end of file
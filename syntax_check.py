@@ -0,0 +1,29 @@
+"""
+Python syntax check shared by app_code_assistant.py and its parser subprocess.
+
+Large uploads are checked by running this file as a separate interpreter, so a
+pathological input can be killed on a timeout without forking the multithreaded
+Streamlit server. The code is read from stdin and the outcome is written to
+stdout as JSON: null, or [message, line number].
+"""
+import ast
+import json
+import sys
+from typing import Optional
+
+def parse_error(code: str) -> Optional[tuple[str, Optional[int]]]:
+    """Parse code and return (message, line number) of the first syntax error, or None."""
+    try:
+        ast.parse(code)
+    except SyntaxError as e:
+        return e.msg, e.lineno
+    except (RecursionError, MemoryError):
+        return "code is too deeply nested to parse", None
+    return None
+
+def main() -> None:
+    code = sys.stdin.buffer.read().decode("utf-8")
+    json.dump(parse_error(code), sys.stdout)
+
+if __name__ == "__main__":
+    main()